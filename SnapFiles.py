@@ -22,29 +22,36 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import http.server
+import io
 import os
 import getpass
 import re
-import socketserver
 import urllib.request
 import urllib.parse
-import tempfile
 import shutil
 import sys
+import threading
 import argparse
+import collections
 
 VERSION = "V1.4"
 DEFAULT_PORT = 7083                         # F+S (File System) in ASCII Decimal
+MAX_OPEN_FILES = 512                        # Well under the usual limit of 1024 open files per process
+FILE_LOCKS = 1024                           # How many locks FileCache shares out between files (see lockPath())
+SENDFILE_SIZE = 64 * 1024                   # Reads at least this big are sent straight from the file (see FileRange)
 
-f = tempfile.NamedTemporaryFile(mode="w+", suffix=".tmp", prefix="snap", delete=False)
-TEMPORARY_FILE_NAME = f.name
-f.close()
+LINESEP = os.linesep                        # \r\n on Windows, \n everywhere else
+LINESEP_BYTES = LINESEP.encode("utf-8")
+LINESEP_LENGTH = len(LINESEP)
+LINESEP_IS_LF = LINESEP == "\n"            # If so there's no need to change line endings
+# Worked out once here as they're used on every line read or written
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-t", "--trace", help="display tracing information", action="store_true")
 parser.add_argument("-p", "--port", help="use a particular port", action="store", default=DEFAULT_PORT, type=int)
-SHOW_TRACE = parser.parse_args().trace
-PORT = parser.parse_args().port
+args = parser.parse_args()
+SHOW_TRACE = args.trace
+PORT = args.port
 
 # These three path functions should work on Mac, Windows, Linux (Raspberry Pi)
 def HOMEPath():
@@ -75,23 +82,75 @@ def snapFilesPath(username):
     terminating / (or \\) isn't doubled.  
     """
 
-    return os.path.join(documentsPath(), "SnapFiles", username)
+    return os.path.join(SNAPFILES_ROOT, username)
+
+SNAPFILES_ROOT = os.path.join(documentsPath(), "SnapFiles")
+# The home directory doesn't change while we're running so work this out once rather than on every request
+
+MADE_DIRECTORIES = set()
+MAX_MADE_DIRECTORIES = 1024
+# The directories that ensureDirectory() has made (or found already there). There's one for each user, so
+#   that it can't grow forever it's emptied when it gets to MAX_MADE_DIRECTORIES: all that costs is one
+#   makedirs() for each user the next time they're seen
+
+def ensureDirectory(path):
+    """ Makes the directory path, and any intermediate directories, if it doesn't exist. Once that's been
+    done for a path we remember it and don't look again, so there's no stat on every request (if the directory
+    is deleted while we're running it won't be made again, but that's not something Snap! can do) """
+    if path not in MADE_DIRECTORIES:
+        os.makedirs(path, exist_ok=True)    # exist_ok as it may be there already, or another thread may have just made it
+        if len(MADE_DIRECTORIES) >= MAX_MADE_DIRECTORIES:
+            MADE_DIRECTORIES.clear()
+        MADE_DIRECTORIES.add(path)
+
+def userPath(username):
+    """ Returns snapFilesPath(username), making the directory if it doesn't exist """
+    path = snapFilesPath(username)
+    if username:
+        ensureDirectory(path)
+
+    return path
 
 def filepath(username, filename):
     """ Returns the absolute file path given a file name. Anything other than a filename
     and extension is removed from filename.
     """
-    if username and not os.path.exists(snapFilesPath(username)):
-        os.makedirs(snapFilesPath(username))
-
-    return os.path.join(snapFilesPath(username), os.path.basename(filename))
+    return os.path.join(userPath(username), os.path.basename(filename))
+
+SAFE_USERNAME = re.compile(r"[\w .-]*")
+# Letters, digits, _, space, . and - but no / or \ (or : on Windows), so a username can't take us outside SnapFiles
+
+def validUsername(username):
+    """ Returns True if username is safe to use as a directory in SnapFiles. It must match SAFE_USERNAME
+    and not be . or .. (which would be SnapFiles itself or the Documents folder) """
+    return SAFE_USERNAME.fullmatch(username) is not None and username not in (".", "..")
+
+def validFilename(filename):
+    """ Returns True if filename is safe to use in filepath(). Any path is removed there, but what's left
+    mustn't be empty, . or .. as they are directories rather than files """
+    return os.path.basename(filename) not in ("", ".", "..")
+
+def parseQuery(query):
+    """ Returns a dictionary of the parameters in query (the part of the URL after the ?), e.g.,
+    file=test.txt&data=hello gives {"file": "test.txt", "data": "hello"}.
+
+    This does what we used from urllib.parse.parse_qs() without building a list for every parameter:
+    Snap! never repeats a parameter, but if it does the first value is used, as it was with parse_qs()[0].
+    Parameters with no value are left out, also as parse_qs() does. Only the values are unquoted as the
+    names are always plain text """
+    parsedQuery = {}
+    for parameter in query.split("&"):
+        name, _, value = parameter.partition("=")
+        if value and name not in parsedQuery:
+            parsedQuery[name] = urllib.parse.unquote_plus(value)
+    return parsedQuery
 
 def debug(message):
     global SHOW_TRACE
     if SHOW_TRACE:
         print(message)
 
-class FileCache(dict):
+class FileCache(collections.OrderedDict):
     """ I maintain a cache of files, keyed by name (actually the full path so that two files with the 
     same name can be accessed as long as they are in different directories, although for security reasons
     currently only one path, to the user's home directory, is supported).
@@ -101,81 +160,223 @@ class FileCache(dict):
    
     Initially I will just hold the object returned on an open, so including its read/write position.
 
+    The server handles each request on its own thread, so each file has a lock: requests for different
+    files can run in parallel but requests for the same file are taken one at a time. There's a fixed
+    number (FILE_LOCKS) of locks, shared out by the file's path, so they don't grow in number however
+    many files are used (the cost is that two files occasionally share a lock, and so wait for each other).
+
+    No more than MAX_OPEN_FILES are kept open: I'm ordered from least to most recently used, and when
+    there are too many the least recently used are closed. They are opened again if they're used again
+    (although their positions are lost, as they would be after a close).
+
+    I also remember the position of each file (see tell()), so finding it, e.g., to check for the end of a file,
+    doesn't need a system call.
+
     TODO: pass homepath into constructor
     """
+    def __init__(self):
+        super().__init__()
+        self.locks = [threading.RLock() for i in range(FILE_LOCKS)]
+        self.positions = {}                 # Keyed by full path, like the files: None if we don't know (tell() will find out)
+
+    def lock(self, username, name):
+        """ Returns the lock for the file. It's re-entrant
+        so that a method holding it can call another that takes it too, e.g., setPosition calls file() """
+        return self.lockPath(filepath(username, name))
+
+    def lockPath(self, filename):
+        """ As lock() but given the full path, for methods that have already worked it out. The path's hash
+        picks the lock, so a file always gets the same one. Sharing is safe as nothing waits for a second lock
+        while holding one, except lockBoth() which takes them in order (and the locks are re-entrant, so a
+        thread that already holds a lock for one file can take it again for another) """
+        return self.locks[hash(filename) % FILE_LOCKS]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closeAll()         # So everything written gets flushed when the server stops
+
     def closeAll(self):
-        for file in self:
-            self[file].close    
-        # Trouble with doing self.close() is that we are iterating over a dictionary but the dictionary changes during the iteration
-        #   because of the self.pop() so we close all the files in the iterator then clear the dictionary
-        self.clear()
+        for filename in list(self):
+            self.closePath(filename)
+        # We iterate over a copy of the keys because closePath() pops each file from the dictionary (and other
+        #   threads may be opening files while we go). closePath() takes each file's lock, so a file isn't closed
+        #   in the middle of another request
 
     def close(self, username, name):
-        if filepath(username, name) in self:
-            self[filepath(username, name)].close()
-            self.pop(filepath(username, name), None)
+        self.closePath(filepath(username, name))
+
+    def closePath(self, filename):
+        with self.lockPath(filename):
+            if filename in self:
+                self.pop(filename).close()
+                self.positions.pop(filename, None)
+
+    def tell(self, f):
+        """ Returns the position of f, an open file from the cache. This is the position recorded by moved() if
+        there is one, otherwise we ask f.tell() (which has to ask the OS) and remember that """
+        position = self.positions.get(f.name)
+        if position is None:
+            position = self.positions[f.name] = f.tell()
+        return position
+
+    def moved(self, f, position):
+        """ Records that f, an open file from the cache, is now at position (None if we don't know). Anything that
+        reads, writes or seeks f must call this, with the caller holding the file's lock """
+        self.positions[f.name] = position
 
     def truncate(self, username, name):
-        if filepath(username, name) in self:
-            self[filepath(username, name)].truncate()
-
-    def file(self, username, name, mode=None):
         filename = filepath(username, name)
-        if filename not in self:
-            if not os.path.isfile(filename):
-                f = open(filename, 'w')
-                f.close()
-            self[filename] = open(filename, "rb+")
-        elif mode and self[filename].mode != mode:
-            print("OPENING FILE IN MODE THAT ISN'T rb+")
-            self[filename].close()
-            self[filename] = open(filename, "rb+")
-        return self[filename]
+        with self.lockPath(filename):
+            if filename in self:
+                self.filePath(filename, "rb+").truncate()
+
+    def file(self, username, name, mode="rb"):
+        return self.filePath(filepath(username, name), mode)
+
+    SUITABLE_MODES = {"rb": ("rb", "rb+"), "rb+": ("rb+",), "ab": ("ab", "rb+")}
+    # For each mode that can be asked for, the modes of an open file that will do instead
+
+    def filePath(self, filename, mode="rb"):
+        """ Returns the open file, opening it if necessary. mode is "rb" if the caller only reads from the file,
+        "rb+" if it writes to it, or "ab" if it only adds to the end of it. Files are only opened for writing when
+        they need to be (so reading works on files we can't write to): if a file is open in a mode that won't do,
+        e.g., it's open for reading and is written to, it's reopened in mode "rb+" at the same position. "rb+" will
+        do for anything, so a file that's used in more than one way settles on one handle rather than being
+        reopened every time the way it's used changes.
+
+        "ab" files are unbuffered and opened with O_APPEND, so each write goes straight to the end of the file
+        in one system call, without a seek or a flush. So that's only used for files that are only appended to """
+        with self.lockPath(filename):
+            if filename not in self:
+                if mode != "ab" and not os.path.isfile(filename):
+                    f = open(filename, 'w')
+                    f.close()
+                self[filename] = open(filename, mode, buffering=0 if mode == "ab" else -1)
+                self.positions[filename] = None if mode == "ab" else 0
+                self.evict(filename)
+            else:
+                if self[filename].mode not in FileCache.SUITABLE_MODES[mode]:
+                    position = self.tell(self[filename])
+                    f = open(filename, "rb+")   # Before closing the old one, so that if this fails (e.g., we can't
+                                                #   write to the file) the file's still open for reading as it was
+                    self[filename].close()
+                    self[filename] = f
+                    f.seek(position)
+                    self.positions[filename] = position
+                self.move_to_end(filename)
+            return self[filename]
+
+    def evict(self, keep):
+        """ Closes the least recently used files until no more than MAX_OPEN_FILES are open. Files that another
+        thread is using (and keep, the file that's just been opened) are skipped: if every file is in use then
+        we stay over the limit until the next file is opened """
+        while len(self) > MAX_OPEN_FILES:
+            for filename in list(self):
+                if filename == keep:
+                    continue
+                lock = self.lockPath(filename)
+                if lock.acquire(blocking=False):    # Not blocking, as waiting for another file while holding keep's lock could deadlock
+                    try:
+                        if filename in self:
+                            self.pop(filename).close()
+                            self.positions.pop(filename, None)
+                    finally:
+                        lock.release()
+                    break
+            else:
+                return
 
     def setPosition(self, username, name, toPosition, whence):
-        f = self.file(username, name)
-        self[filepath(username, name)].seek(toPosition, whence)
+        filename = filepath(username, name)
+        with self.lockPath(filename):
+            f = self.filePath(filename)
+            self.moved(f, f.seek(toPosition, whence))
 
     def reset(self, username, name):
         self.setPosition(username, name, 0)
 
     def getPosition(self, username, name):
-        return self.file(username, name).tell()
+        filename = filepath(username, name)
+        with self.lockPath(filename):
+            return self.tell(self.filePath(filename))
 
     def remove(self, username, name):
-        self.close(username, name)
-        try:
-            os.remove(filepath(username, name))
-            return (True, "")
-        except OSError as e:
-            return (False, e.strerror)
-        except:
-            return (False, "unknown error ")
+        filename = filepath(username, name)
+        with self.lockPath(filename):
+            self.closePath(filename)
+            try:
+                os.remove(filename)
+                return (True, "")
+            except OSError as e:
+                return (False, e.strerror)
+            except:
+                return (False, "unknown error ")
+
+    def lockBoth(self, filename, otherFilename):
+        """ Returns the locks for two files in a fixed order (locks are never thrown away, so id() will do), so that two threads locking the same
+        pair of files, e.g., renaming a to b and b to a, can't each end up holding one and waiting for the other """
+        return sorted([self.lockPath(filename), self.lockPath(otherFilename)], key=id)
 
     def rename(self, username, name, newname):
-        self.close(username, name)
-        self.close(username, newname) # It might be open, you never know! If it exists then we'll still get an error
-        try:
-            os.rename(filepath(username, name), filepath(username, newname))
-            self.setPosition(username, newname, 0, 0)
-
-            return (True, "")
-        except OSError as e:
-            return (False, e.strerror)
-        except:
-            return (False, "unknown error")
+        oldFilename, newFilename = filepath(username, name), filepath(username, newname)
+        first, second = self.lockBoth(oldFilename, newFilename)
+        with first, second:
+            self.closePath(oldFilename)
+            self.closePath(newFilename) # It might be open, you never know! If it exists then we'll still get an error
+            try:
+                os.rename(oldFilename, newFilename)
+                self.setPosition(username, newname, 0, 0)
+
+                return (True, "")
+            except OSError as e:
+                return (False, e.strerror)
+            except:
+                return (False, "unknown error")
 
     def copyFile(self, username, fromFile, toFile):
-        self.close(username, fromFile)
-        self.close(username, toFile)
+        fromFilename, toFilename = filepath(username, fromFile), filepath(username, toFile)
+        first, second = self.lockBoth(fromFilename, toFilename)
+        with first, second:
+            self.closePath(fromFilename)
+            self.closePath(toFilename)
+
+            try:
+                shutil.copyfile(fromFilename, toFilename)   # Not sure this ever throws an exception
+                return (True, "")
+            except OSError as e:
+                return (False, e.strerror)
+            except:
+                return (False, "unknown error")
+
+class FileRange():
+    """ I am part of a file to be sent as the body of a response. For a big read there's no point
+    reading it into Python, decoding it and encoding it again just to send it: instead the handler
+    gives my file to socket.sendfile(), which gets the OS to copy from the file to the socket directly
+    (or falls back to ordinary sends where it can't).
+
+    file is a separate handle from the one in the FileCache, so it doesn't matter if that one is moved
+    or closed before I'm sent. I'm sent after the command has finished and without the file's lock:
+    holding it for as long as a slow client takes to read me would hold up every other request for
+    the file (and for any other file that shares its lock). So a request that writes to the file
+    while I'm being sent may change what's sent, as with any read that races a write. If the file
+    shrinks (truncate, or copy onto it) there's less to send than the Content-Length says, and the
+    handler closes the connection rather than leave the client waiting for the rest.
+    """
+    def __init__(self, file, offset, count):
+        self.file = file
+        self.offset = offset
+        self.count = count
 
-        try:
-            shutil.copyfile(filepath(username, fromFile), filepath(username, toFile))   # Not sure this ever throws an exception
-            return (True, "")
-        except OSError as e:
-            return (False, e.strerror)
-        except:
-            return (False, "unknown error")
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return True             # Even if count is 0, as SimpleHTTPRequestHandler only closes me if I'm true
+
+    def close(self):
+        self.file.close()
 
 class Responder():
     """ I hold a 'jump table' and act as a jump table handler. This is the 
@@ -191,64 +392,94 @@ class Responder():
        else:
        
     structure """
+    @staticmethod
     def writeResult(data):
-        """ Write data to the temporary file and return the name of the file.
-        I wonder if we could hold the temporary file in the file cache and so
-        just use one file instead of littering the place with files """
-        f = open(TEMPORARY_FILE_NAME, "w+")
-        f.writelines(data if type(data) == type([]) else str(data))                    
-        f.close()
-            
-        return TEMPORARY_FILE_NAME
+        """ Return data as the UTF-8 encoded bytes of the response body. This used to go via a
+        temporary (text mode) file, so \n still becomes os.linesep as it did when it was written
+        there. Keeping it in memory saves the open/write/close/reopen on every request and means
+        two clients can't overwrite each other's results.
+
+        data that's already bytes, e.g., read from a file, is used as it is rather than being
+        decoded and encoded again """
+        if type(data) == bytes:
+            return data if LINESEP_IS_LF else data.replace(b"\n", LINESEP_BYTES)
+        result = "".join(data) if type(data) == type([]) else str(data)
+        if not LINESEP_IS_LF:
+            result = result.replace("\n", LINESEP)
+        return result.encode("utf-8")
         
+    @staticmethod
     def error(message):
         return Responder.writeResult("ERROR: " + message)
         
+    @staticmethod
     def OK():
         return Responder.writeResult("OK")   
         
+    @staticmethod
     def readLine(f):
-        """ Read from f, byte at a time, until you get to os.linesep. On Windows then os.linesep is
-        \r\n so we skip the \n as well as the \r """
-        result = ""
-        while True:
-            ch = f.read(1).decode("utf-8")
-            if ch == '':    # End of file
-                return result
-            if ch != os.linesep[0]:
-                result += ch
-            else:
-                if len(os.linesep) > 1:
-                    ch = f.read(1)
-                return result 
-
+        """ Read from f up to and including the next \n and return the line (as bytes) without its os.linesep.
+        f is buffered, so this is one readline() rather than a read(1) per byte. On Windows
+        os.linesep is \r\n so the \r is removed as well as the \n """
+        position = files.tell(f)
+        line = f.readline()
+        files.moved(f, position + len(line))
+        if line.endswith(LINESEP_BYTES):    # Not at end of file
+            line = line[:-LINESEP_LENGTH]
+        return line
+
+    @staticmethod
+    def readRange(f, count):
+        """ Returns a FileRange for the next count bytes (or as many as there are) of f and moves f on past
+        them as if they had been read. If there's nothing to read it returns b"" instead. The caller holds
+        the file's lock """
+        f.flush()               # So that anything we've written is in the file when it's sent
+        offset = files.tell(f)
+        count = max(min(count, os.fstat(f.fileno()).st_size - offset), 0)
+        if count == 0:
+            return b""
+        rangeFile = open(f.name, "rb")  # First, so if it fails we haven't moved f
+        files.moved(f, f.seek(offset + count))
+        return FileRange(rangeFile, offset, count)
+
+    @staticmethod
     def readall(username, filename, data, parsedQuery):
         if filename:
             debug("read all from " + filename)
                
-            f = files.file(username, filename)                # Why is files accessible? Shouldn't I have to label is global? 
-            f.seek(0)
-            lines = f.read().decode("utf-8")        # All these separate lines lines are for debugging, although putting it into 1 line stinks!
-            lines = lines.replace(os.linesep, '\n')
-            lines = lines.split('\n')[:-1]
-            lines = [line + os.linesep[-1] for line in lines]
-            if lines:                                                               # Otherwise you get an error reading from an empty file
-                lines[-1] = lines[-1] if lines[-1][-1] != '\n' else lines[-1][:-1]  # The last line has a trailing \n removed if it ends in one!
+            with files.lock(username, filename):                  # So another request can't move the position between the seek and the read
+                f = files.file(username, filename)                # Why is files accessible? Shouldn't I have to label is global? 
+                f.seek(0)
+                lines = f.read()
+                files.moved(f, len(lines))
+            if not LINESEP_IS_LF:
+                lines = lines.replace(LINESEP_BYTES, b'\n')
+            lines = lines[:max(lines.rfind(b'\n'), 0)]
+            # Everything up to (but not including) the last \n, so the lines are separated by \n with no trailing \n, and
+            #   anything after the last \n is dropped. Doing it on the bytes in one go saves splitting into a list of lines
             return Responder.writeResult(lines)      # Still not ideal as you get a blank element returned, but this might be to do with Snap!
         else:
             return Responder.error("no filename") 
 
+    @staticmethod
     def append(username, filename, data, parsedQuery):
         if filename:
             if data:
                 debug("append to " + filename + " data " + data )
                
-                f = files.file(username, filename)
-                f.seek(0, 2)        # Position to the end of the file
-                r = bytes(data + os.linesep, "utf-8")
-
-                f.write(bytes(data + os.linesep, "utf-8"))
-                f.flush()
+                line = data.encode("utf-8") + LINESEP_BYTES
+                with files.lock(username, filename):
+                    f = files.file(username, filename, "ab")
+                    if f.mode != "ab":      # Already open for reading and writing
+                        end = f.seek(0, 2)  # Position to the end of the file
+                        f.write(line)
+                        f.flush()
+                        files.moved(f, end + len(line))
+                    else:
+                        written = f.write(line)     # Goes to the end of the file, which is where we're left
+                        while written < len(line):  # f is unbuffered, so it may not write everything at once
+                            written += f.write(line[written:])
+                        files.moved(f, None)    # ... but we don't know where that is without asking
 
                 # What do we return?
                 return Responder.OK()
@@ -257,20 +488,28 @@ class Responder():
         else:
             return Responder.error("no filename")
 
+    @staticmethod
     def read(username, filename, data, parsedQuery):
         if filename:
             if data:
                 debug("read from " + filename + " mode " + data)
                 if data == "nextline":
-                    f = files.file(username, filename)
-                    return Responder.writeResult(Responder.readLine(f)) # Need to read until we've read os.linesep (this is \r\n in Windows)
+                    with files.lock(username, filename):
+                        f = files.file(username, filename)
+                        return Responder.writeResult(Responder.readLine(f)) # Need to read until we've read os.linesep (this is \r\n in Windows)
                 elif data == "characters":
                     if "count" in parsedQuery:
-                        count = parsedQuery["count"][0]
+                        count = parsedQuery["count"]
                         if count.isdigit():
                             debug("read from " + filename + " mode " + data + " count " + str(count))
-                            result = files.file(username, filename).read(int(count)).decode("utf-8")
-                            debug("result " + result)
+                            with files.lock(username, filename):
+                                f = files.file(username, filename)
+                                if int(count) >= SENDFILE_SIZE and LINESEP_IS_LF:   # Otherwise the line endings need changing on the way
+                                    return Responder.readRange(f, int(count))
+                                position = files.tell(f)
+                                result = f.read(int(count))
+                                files.moved(f, position + len(result))
+                            debug("result " + str(result))
                             return Responder.writeResult(result)
                         else:
                             return Responder.error("invalid count")
@@ -283,21 +522,25 @@ class Responder():
         else:
             return Responder.error("no filename")
 
+    @staticmethod
     def closeAll(username, filename, data, parsedQuery):
         files.closeAll()
         return Responder.OK()
 
+    @staticmethod
     def atEnd(username, filename, data, parsedQuery):
         if filename:
             debug("at end of " + filename)
                
-            f = files.file(username, filename, None)
+            with files.lock(username, filename):
+                f = files.file(username, filename)
                 
-            return Responder.writeResult(str(f.tell() == os.fstat(f.fileno()).st_size))
+                return Responder.writeResult(str(files.tell(f) == os.fstat(f.fileno()).st_size))
             # Above line to detect end of file from http://stackoverflow.com/questions/10140281/how-to-find-out-whether-a-file-is-at-its-eof+
         else:
             return Responder.error("no filename")
 
+    @staticmethod
     def close(username, filename, data, parsedQuery):
         if filename:
             debug("close " + filename)
@@ -308,6 +551,7 @@ class Responder():
         else:
             return Responder.error("no filename")
 
+    @staticmethod
     def truncate(username, filename, data, parsedQuery):
         if filename:
             debug("truncate " + filename)
@@ -319,12 +563,13 @@ class Responder():
         else:
             return Responder.error("no filename")
 
+    @staticmethod
     def setPosition(username, filename, data, parsedQuery):
         if filename:
             if data:
                 debug("setposition of " + filename + " to " + data)
                 if "relativeto" in parsedQuery:
-                    relativeTo = parsedQuery["relativeto"][0]
+                    relativeTo = parsedQuery["relativeto"]
                     if relativeTo == "start":
                         whence = 0
                     elif relativeTo == "current":
@@ -347,6 +592,7 @@ class Responder():
         else:
             return Responder.error("no filename")
 
+    @staticmethod
     def position(username, filename, data, parsedQuery):
         if filename:
             debug("get position " + filename + "=" + str(files.getPosition(username, filename)))
@@ -354,6 +600,7 @@ class Responder():
         else:
             return Responder.error("no filename")
 
+    @staticmethod
     def exists(username, filename, data, parsedQuery):
         if filename:
             debug("exists " + filename)
@@ -362,6 +609,7 @@ class Responder():
         else:
             return Responder.error("no filename")
 
+    @staticmethod
     def delete(username, filename, data, parsedQuery):
         if filename:
             debug("delete " + filename)
@@ -374,10 +622,11 @@ class Responder():
         else:
             return Responder.error("no filename")
 
+    @staticmethod
     def rename(username, filename, data, parsedQuery):
         if filename:
             if "newname" in parsedQuery:
-                newname = parsedQuery["newname"][0]
+                newname = parsedQuery["newname"]
                 debug("renaming " + filepath(username, filename) + " to " + newname)
 
                 result = files.rename(username, filename, newname)
@@ -390,10 +639,11 @@ class Responder():
         else:
             return Responder.error("no old filename")
 
+    @staticmethod
     def copy(username, filename, data, parsedQuery):
         if filename:
             if "tofile" in parsedQuery:
-                tofile = parsedQuery["tofile"][0]
+                tofile = parsedQuery["tofile"]
                 debug("copying " + filepath(username, filename) + " to " + tofile)
 
                 result = files.copyFile(username, filename, tofile)
@@ -406,14 +656,17 @@ class Responder():
         else:
             return Responder.error("no source filename")
 
+    @staticmethod
     def write(username, filename, data, parsedQuery):
         if filename:
             if data:
                 debug("writing " + data + " to " + filepath(username, filename))
 
-                f = files.file(username, filename)   
+                with files.lock(username, filename):
+                    f = files.file(username, filename, "rb+")   
 
-                f.write(bytes(data, "utf-8"))     # bytearray in Python2  
+                    position = files.tell(f)
+                    files.moved(f, position + f.write(bytes(data, "utf-8")))     # bytearray in Python2  
 
                 return Responder.OK()
             else:
@@ -421,6 +674,7 @@ class Responder():
         else:
             return Responder.error("no filename")
 
+    @staticmethod
     def server(username, filename, data, parsedQuery): # Ignore filename
         if data:
             if data == "sfs_version":
@@ -432,17 +686,33 @@ class Responder():
         else:
             return Responder.error("no server information requested")
 
-    CALL_TABLE = {"readall": readall, "append": append, "read": read, "closeall": closeAll, "atend": atEnd, "close": close, "truncate": truncate,
-                  "setposition": setPosition, "getposition": position, "exists": exists, "delete": delete, "rename": rename, "copy": copy, "write": write, "server": server}
-
+    @staticmethod
     def handle(command, username, filename, data, parsedQuery):
-        if command in Responder.CALL_TABLE:
-            return Responder.CALL_TABLE[command](username, filename, data, parsedQuery)
-        else:
-            return Responder.writeResult("invalid command " + command)
+        """ command is the path from the URL, e.g., /readall. Commands are nearly always sent in lower case
+        so we only lower() it if it isn't found as it is """
+        if not validUsername(username):
+            return Responder.error("invalid username")
+        for name in (filename, parsedQuery.get("newname"), parsedQuery.get("tofile")):
+            if name is not None and not validFilename(name):
+                return Responder.error("invalid filename " + name)
+        # Checked once here, before anything uses them to make a path
+
+        fn = Responder.CALL_TABLE.get(command) or Responder.CALL_TABLE.get(command.lower())
+        return fn(username, filename, data, parsedQuery) if fn else Responder.writeResult("invalid command " + command[1:].lower())
+
+    # Built once, when the class is defined. __func__ because a staticmethod object can't be called directly before Python 3.10.
+    #   The keys include the / so the path from the URL can be looked up without slicing it
+    CALL_TABLE = {"/readall": readall.__func__, "/append": append.__func__, "/read": read.__func__, "/closeall": closeAll.__func__,
+                  "/atend": atEnd.__func__, "/close": close.__func__, "/truncate": truncate.__func__, "/setposition": setPosition.__func__,
+                  "/getposition": position.__func__, "/exists": exists.__func__, "/delete": delete.__func__, "/rename": rename.__func__,
+                  "/copy": copy.__func__, "/write": write.__func__, "/server": server.__func__}
 
 
 class CORSHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    wbufsize = io.DEFAULT_BUFFER_SIZE
+    # Buffer what we write to the client (by default it isn't) so that the headers and a short result go out together
+    #   in one send when the request's been handled, rather than the headers in one send and the result in another
+
     def send_head(self):
 
         # debug(str(self.client_address))
@@ -451,68 +721,59 @@ class CORSHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         debug("path=" + path)
         # path loResponder.OKs like /<command>?<querystring>, e.g., /readall?file=<filename> etc
 
-        parsedPath = urllib.parse.urlparse(path)
-        # parsedPath loResponder.OKs like this: ParseResult(scheme='', netloc='', path='/readall', params='', query='file=test.txt', fragment='')
-        command = parsedPath.path.lower()
+        command, _, query = path.partition("?")
+        # Snap! only ever sends /<command>?<querystring>, so this does all we need of urllib.parse.urlparse()
         debug("command=" + command)
-
-        query = parsedPath.query
         debug("query=" + query)
 
-        parsedQuery = urllib.parse.parse_qs(query)
-        if "user" in parsedQuery:
-            username = parsedQuery["user"][0]
-        else:
-            username = ""
-
-        if "file" in parsedQuery:
-            filename = parsedQuery["file"][0]
-        else:
-            filename = None
-
-        if "data" in parsedQuery:
-            data = parsedQuery["data"][0]
-        else:
-            data = None
+        parsedQuery = parseQuery(query)
+        username = parsedQuery.get("user", "")
+        filename = parsedQuery.get("file")
+        data = parsedQuery.get("data")
         # filename and data are very common, so we deal with them immediately
 
-        temporaryFile = Responder.handle(command[1:], username, filename, data, parsedQuery)
+        result = Responder.handle(command, username, filename, data, parsedQuery)
         # command is like /append, /server
 
-        debug("temporary file: " + temporaryFile)
-
-        f = open(temporaryFile, "rb")
-        ctype = self.guess_type(temporaryFile)
-
-        self.send_response(200)
-        self.send_header("Content-type", ctype)
-        fs = os.fstat(f.fileno())
-        self.send_header("Content-Length", str(fs[6]))
-        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-
-        return f
+        try:
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(result)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+        except:
+            if isinstance(result, FileRange):
+                result.close()      # Otherwise its file stays open
+            raise
+
+        return result if isinstance(result, FileRange) else io.BytesIO(result)
+        # SimpleHTTPRequestHandler copies this to the client (using copyfile() below) and closes it
+
+    def copyfile(self, source, outputfile):
+        if isinstance(source, FileRange):
+            outputfile.flush()      # Send the headers first, as sendfile() goes straight to the socket
+            if self.connection.sendfile(source.file, source.offset, source.count) < source.count:
+                self.close_connection = True    # The file's shrunk since, so we can't send what we said we would
+        else:
+            super().copyfile(source, outputfile)
 
  
 if __name__ == "__main__":
 
     Handler = CORSHTTPRequestHandler
 
-    files = FileCache()
-    
-    if not os.path.exists(snapFilesPath("")):
-        os.makedirs(snapFilesPath(""))
+    ensureDirectory(snapFilesPath(""))
     # Make sure that ~/Documents/SnapFiles exists, creating it, and
     #   any intermediate directories, if it doesn't            
 
-    httpd = socketserver.TCPServer(("", PORT), Handler)
+    with FileCache() as files, http.server.ThreadingHTTPServer(("", PORT), Handler) as httpd:
+        # Each request gets its own thread so a slow request doesn't hold up the others; FileCache locks each file.
+        #   Leaving the with (e.g., on Ctrl-C) closes the server and then all the open files
 
-    debug("Serving at port " + str(PORT))
-    debug("Go ahead and launch Snap!")
-    debug("Home is " + HOMEPath())
-    debug("Temporary file is " + TEMPORARY_FILE_NAME)
+        debug("Serving at port " + str(PORT))
+        debug("Go ahead and launch Snap!")
+        debug("Home is " + HOMEPath())
 
-    httpd.serve_forever()
+        httpd.serve_forever()
 
 